@@ -3,63 +3,187 @@
 Created by Natkamon Tovanich - version 2022-03-01
 """
 
+import os
+import copy
+from types import SimpleNamespace
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
 from altair import datum
 from vega_datasets import data
-from streamlit_vega_lite import vega_lite_component, altair_component
-import time
 
 st.write('# World Development Indicators')
 
 st.write('## 1. Load data')
-# Load Gapminder data
-# @st.cache decorator skip reloading the code when the apps rerun.
-@st.cache
-def loadData():
-    return pd.read_csv('WDIData.csv')
+DATA_CSV = 'WDIData.csv'
+DATA_PARQUET = 'WDIData.parquet'
+
+# Cached data and charts are dropped after one day,
+# caches keyed on the user inputs keep at most CACHE_ENTRIES results
+CACHE_TTL = 24 * 60 * 60
+CACHE_ENTRIES = 64
+
+# Indicator columns, in the same order as in the CSV file
+indicators = [
+    'Adjusted net national income per capita (constant 2010 US$)',
+    'Agricultural land (% of land area)',
+    'CO2 emissions (kt)',
+    'Forest area (% of land area)',
+    'Fossil fuel energy consumption (% of total)',
+    'GDP per capita (current LCU)',
+    'Gini index (World Bank estimate)',
+    'Hospital beds (per 1,000 people)',
+    'Labor force with advanced education (% of total working-age population with advanced education)',
+    'Life expectancy at birth, total (years)',
+    'Literacy rate, youth total (% of people ages 15-24)',
+    'Population, total',
+    'Poverty gap at $3.20 a day (2011 PPP) (%)',
+    'Urban population (% of total population)',
+]
+
+# Only read the columns we use, with compact types:
+# float32 for indicators, category for the repeated country/region names.
+USECOLS = ['Country', 'Region', 'Year', 'id', *indicators]
+DTYPES = {c: 'float32' for c in indicators}
+DTYPES.update({'Country': 'category', 'Region': 'category', 'Year': 'int16', 'id': 'int16'})
+
+# The parquet snapshot gets the modification time of the CSV it was made from,
+# so a snapshot that does not match the current CSV is never read
+def readSnapshot(csv_mtime):
+    if not os.path.exists(DATA_PARQUET) or os.stat(DATA_PARQUET).st_mtime_ns != csv_mtime:
+        return None
+    try:
+        return pd.read_parquet(DATA_PARQUET, columns=USECOLS)
+    except (OSError, ValueError):
+        # e.g. a damaged file, parse the CSV again
+        return None
+
+# Write to a temporary file first and rename it, so that the snapshot is never read half-written
+def saveSnapshot(df, csv_mtime):
+    tmp = DATA_PARQUET + '.tmp'
+    try:
+        df.to_parquet(tmp, index=False)
+        os.utime(tmp, ns=(csv_mtime, csv_mtime))
+        os.replace(tmp, DATA_PARQUET)
+    except OSError:
+        # e.g. a read-only deployment, keep reading the CSV file
+        pass
 
-df = loadData()
+# Load Gapminder data
+# The first load parses the CSV and saves a parquet snapshot,
+# later cold starts read the (much faster) parquet file instead.
+def loadData(csv_mtime):
+    df = readSnapshot(csv_mtime)
+    from_csv = df is None
+    if from_csv:
+        # na_filter=False skips the NA check on the string columns,
+        # the pyarrow engine still reads empty numeric cells as missing values
+        df = pd.read_csv(DATA_CSV, usecols=USECOLS, dtype=DTYPES, na_filter=False, engine='pyarrow')
+
+    # Make sure the columns have the compact types (e.g. for a snapshot saved with wider types),
+    # this halves the memory moved by every filter and serialization afterwards
+    df = df.astype(DTYPES)
+
+    # Keep the rows in year order, so that every year is one contiguous block of rows
+    # (in memory, and in the parquet snapshot)
+    df = df.sort_values('Year', kind='stable', ignore_index=True)
+    if from_csv:
+        saveSnapshot(df, csv_mtime)
+    return df
+
+# Index the data once, so that the charts can pick a year or a set of countries
+# with a lookup instead of scanning the whole table on every call
+def indexData(df):
+    # The rows are sorted by year, so each year is a slice of rows (a view, not a copy)
+    years = df['Year'].values
+    unique_years = np.unique(years)
+    starts = np.searchsorted(years, unique_years, side='left')
+    stops = np.searchsorted(years, unique_years, side='right')
+    year_groups = {int(y): df.iloc[start:stop] for y, start, stop in zip(unique_years, starts, stops)}
+    df_by_country = df.set_index('Country', drop=False).sort_index()
+    # Country is categorical, its categories are already the unique names
+    country_list = sorted(df['Country'].cat.categories.tolist())
+    return year_groups, df_by_country, country_list
+
+# First and last year with data for every indicator, computed once for all columns
+# (an indicator without any data is left out of both dicts)
+def indicatorYears(df):
+    present = df[indicators].notna()
+    years = present.mul(df['Year'], axis=0).where(present)
+    return years.min().dropna().astype(int).to_dict(), years.max().dropna().astype(int).to_dict()
+
+# @st.cache_resource decorator skip reloading the code when the apps rerun.
+# The data and all the views computed from it are kept in one cache entry,
+# shared by every session without hashing or copying on each rerun.
+# The modification time of the CSV file is part of the cache key,
+# so the data is loaded again when the file changes.
+# It is also kept as the version of the data: the caches below take it as a hashed
+# argument next to the unhashed data, so that they are rebuilt with the new data too.
+@st.cache_resource(ttl=CACHE_TTL)
+def loadBundle(csv_mtime):
+    df = loadData(csv_mtime)
+    year_groups, df_by_country, country_list = indexData(df)
+    first_year, last_year = indicatorYears(df)
+    return SimpleNamespace(df=df, year_groups=year_groups, df_by_country=df_by_country,
+                           country_list=country_list, first_year=first_year, last_year=last_year,
+                           version=csv_mtime)
+
+wdi = loadBundle(os.stat(DATA_CSV).st_mtime_ns)
 
 # Use st.write() to render any objects on the web app
-st.write('This is dataset table.')
-st.write(df)
-
-# Magic command: Streamlit automatically writes a variable 
-# or a literal value to your app using st.write().
-'List of columns in the table.'
-df.columns.values
+# The table is only sent to the browser when the checkbox is ticked
+# (the content of a collapsed st.expander is still sent), and only the first rows
+# are shown, as scrolling through the full table is not useful
+if st.checkbox('Show raw data'):
+    st.write('This is dataset table.')
+    st.write(wdi.df.head(1000))
+
+    # Magic command: Streamlit automatically writes a variable 
+    # or a literal value to your app using st.write().
+    'List of columns in the table.'
+    wdi.df.columns.tolist()
 
 # Select year
 year = 2012
-source = df[df['Year'] == 2012]
+source = wdi.year_groups[year]
 
 # Create an Altair chart
 st.write('#### This is the first chart we created.')
 
+# Keep only the columns used by a chart, so that less data is sent to the browser
+# (dict.fromkeys drops duplicates, e.g. when the same indicator is on both axes)
+def chartColumns(source, *columns):
+    return source[list(dict.fromkeys(columns))]
+
 # Create the bubble chart with selection
-@st.cache(allow_output_mutation=True)
-def plotTheFirstChart(source):
-    selected = alt.selection_multi(encodings=['x', 'y', 'size'])
+# (a leading underscore tells Streamlit not to hash the DataFrame argument,
+# the version of the data is hashed instead)
+@st.cache_resource(ttl=CACHE_TTL)
+def plotTheFirstChart(_source, version):
+    selected = alt.selection_point(name='selected', encodings=['x', 'y', 'size'])
+
+    plot_df = chartColumns(_source, 'Country', 'Region', 'GDP per capita (current LCU)',
+                           'Life expectancy at birth, total (years)', 'Population, total')
 
-    chart = alt.Chart(source).mark_circle(opacity=0.7, stroke='black', strokeWidth=1).encode(
+    chart = alt.Chart(plot_df).mark_circle(opacity=0.7, stroke='black', strokeWidth=1).encode(
         x=alt.X('GDP per capita (current LCU):Q', scale=alt.Scale(type='log', zero=False)),
         y=alt.Y('Life expectancy at birth, total (years):Q', scale=alt.Scale(zero=False)),
         size=alt.Size('Population, total:Q', scale=alt.Scale(range=(30, 3000), zero=False)),
         color=alt.condition(selected, alt.Color('Region:N'), alt.value('lightgray')),
         tooltip='Country'
-    ).add_selection(selected).properties(width=800, height=500).interactive()
+    ).add_params(selected).properties(width=800, height=500).interactive()
 
     return chart
 
 # Showing Altair chait on the apps
-st.altair_chart(plotTheFirstChart(source), use_container_width=False)
+st.altair_chart(plotTheFirstChart(source, wdi.version), width='content')
 
 # Create the world map chart
-@st.cache(allow_output_mutation=True)
-def plotChoroplethMap(source):
+@st.cache_resource(ttl=CACHE_TTL)
+def plotChoroplethMap(_source, version):
     countries = alt.topo_feature(data.world_110m.url, 'countries')
+    lookup_df = chartColumns(_source, 'id', 'CO2 emissions (kt)').dropna()
 
     chart = alt.Chart(countries).mark_geoshape(
         stroke='white'
@@ -67,7 +191,7 @@ def plotChoroplethMap(source):
         color='CO2 emissions (kt):Q'
     ).transform_lookup(
         lookup='id',
-        from_=alt.LookupData(source, 'id', ['CO2 emissions (kt)'])
+        from_=alt.LookupData(lookup_df, 'id', ['CO2 emissions (kt)'])
     ).project('equirectangular').properties(
         width=800,
         height=500,
@@ -77,12 +201,12 @@ def plotChoroplethMap(source):
     return chart
 
 # Showing Altair chart on the apps
-st.altair_chart(plotChoroplethMap(source), use_container_width=False)
+st.altair_chart(plotChoroplethMap(source, wdi.version), width='content')
 
 st.write('## 3. Add user inputs and update the chart')
 
 # What if we can select the variable to display in the chart
-indicators = list(df.columns.values[2:16])
+# (the list of indicators is defined next to the loader in section 1)
 
 x_sel = st.sidebar.selectbox('X-axis', indicators, 5)
 x_log = st.sidebar.checkbox('Log scale on x-axis', value=True)
@@ -91,16 +215,12 @@ y_sel = st.sidebar.selectbox('Y-axis', indicators, 9)
 y_log = st.sidebar.checkbox('Log scale on y-axis')
 
 # What if we can filter some countries to show on the chart
-countries = set(df['Country'])
-countries_sel = st.sidebar.multiselect('Countries', countries)
+countries_sel = st.sidebar.multiselect('Countries', wdi.country_list)
 
 # Put those inputs on the sidebar
 
 # What if we can see the statistics over the years
-if 'year' not in st.session_state:
-    year = st.slider('Year', 1960, 2020, 2015)
-else:
-    year = st.slider('Year', 1960, 2020, st.session_state.year)
+year = st.slider('Year', 1960, 2020, 2015)
 
 # Select the data according to the user inputs
 keys = dict()
@@ -115,72 +235,137 @@ keys['countries'] = countries_sel
 text = st.empty()
 text.markdown("Year: {}".format(year))
 
-# Plot the bubble chart again as a function with st.cache decorator
-@st.cache(allow_output_mutation=True)
-def plotBubbleChart(df, keys, global_max=False):
+# Select the rows of the bubble chart for the year and countries in keys
+# Only the version and keys are hashed, _wdi is the loaded data bundle
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES)
+def bubbleSource(_wdi, version, keys):
+    source = _wdi.year_groups.get(keys['year'], _wdi.df.iloc[:0])
+
     # Filter countries, if they are selected in the input
     if len(keys['countries']) > 0:
-        df = df[df['Country'].isin(keys['countries'])]
+        # Country is categorical, so compare the integer codes instead of the names
+        selected_codes = source['Country'].cat.categories.get_indexer(keys['countries'])
+        source = source.iloc[np.isin(source['Country'].cat.codes.values, selected_codes)]
+
+    source = source.dropna(subset=[keys['x'], keys['y']])
+    return chartColumns(source, 'Country', 'Region', keys['x'], keys['y'], 'Population, total')
+
+# Build the Vega-Lite spec of the bubble chart once with Altair, and keep it as a template.
+# Only the fields and scales change with the inputs, so they are set directly in a copy
+# of the spec instead of going through Altair (and its schema validation) on every rerun.
+# The chart has no data, it is passed separately when the chart is drawn.
+# The point selection is projected on Country, so a click returns the name of the selected countries.
+@st.cache_resource(ttl=CACHE_TTL)
+def bubbleSpecTemplate():
+    selected = alt.selection_point(name='selected', fields=['Country'])
+
+    chart = alt.Chart().mark_circle(opacity=0.7, stroke='black', strokeWidth=1).encode(
+        x=alt.X('{}:Q'.format(indicators[5]), scale=alt.Scale(type='log', zero=False)),
+        y=alt.Y('{}:Q'.format(indicators[9]), scale=alt.Scale(zero=False)),
+        size=alt.Size('Population, total:Q', scale=alt.Scale(range=(30, 3000), zero=False)),
+        color=alt.condition(selected, alt.Color('Region:N'), alt.value('lightgray')),
+        tooltip='Country:N'
+    ).add_params(selected).properties(width=800, height=500).interactive()
+
+    return chart.to_dict()
+
+# The spec only depends on the axes, not on the year or the countries (they only change the data)
+def bubbleSpec(x, y, x_log, y_log):
+    spec = copy.deepcopy(bubbleSpecTemplate())
+    encoding = spec['encoding']
+    for axis, field, log in [('x', x, x_log), ('y', y, y_log)]:
+        encoding[axis]['field'] = field
+        encoding[axis]['scale'] = {'type': 'log', 'zero': False} if log else {'zero': False}
+    return spec
+
+# Keep the last chart in the session state and reuse it when the inputs did not change,
+# so that reruns from other widgets don't rebuild the bubble chart (or the data changed)
+keys_hash = hash((wdi.version,) + tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in keys.items()))
+if st.session_state.get('last_keys_hash') != keys_hash:
+    st.session_state['last_keys_hash'] = keys_hash
+    st.session_state['last_chart'] = {
+        'source': bubbleSource(wdi, wdi.version, keys),
+        'spec': bubbleSpec(keys['x'], keys['y'], keys['x_log'], keys['y_log']),
+    }
+
+last_chart = st.session_state['last_chart']
+bubble_source, bubble_spec = last_chart['source'], last_chart['spec']
 
-    # Set the scale based on whether the value needs to be transform to log scale or not
-    if global_max:
-        x_scale = alt.Scale(domain=[df[keys['x']].min(), df[keys['x']].max()], type='log', zero=False) if keys['x_log'] else alt.Scale(domain=[df[keys['x']].min(), df[keys['x']].max()], zero=False)
-        y_scale = alt.Scale(domain=[df[keys['y']].min(), df[keys['y']].max()], type='log', zero=False) if keys['y_log'] else alt.Scale(domain=[df[keys['y']].min(), df[keys['y']].max()], zero=False)
-        size_scale = alt.Scale(domain=[df['Population, total'].min(), df['Population, total'].max()], range=(30, 3000), zero=False)
-    else:
-        x_scale = alt.Scale(type='log', zero=False) if keys['x_log'] else alt.Scale(zero=False)
-        y_scale = alt.Scale(type='log', zero=False) if keys['y_log'] else alt.Scale(zero=False)
-        size_scale = alt.Scale(range=(30, 3000), zero=False)
+# What if we can animate the chart to see statistics over the years
 
-    source = df[df['Year'] == keys['year']]
-    source = source[(~source[keys['x']].isna()) & (~source[keys['y']].isna())]
+# Find the minimum and maximum year for the selected variables
+# (None if one of them has no data, or if they have no year in common)
+def minmaxYear(x, y):
+    if x not in wdi.first_year or y not in wdi.first_year:
+        return None
+    first = max(wdi.first_year[x], wdi.first_year[y])
+    last = min(wdi.last_year[x], wdi.last_year[y])
+    return (first, last) if first <= last else None
+
+# Set the scale based on whether the value needs to be transform to log scale or not
+# The domain covers every year in df so the axes stay fixed over the years
+def bubbleScales(df, keys):
+    x_domain = [df[keys['x']].min(), df[keys['x']].max()]
+    y_domain = [df[keys['y']].min(), df[keys['y']].max()]
+    size_domain = [df['Population, total'].min(), df['Population, total'].max()]
+    x_scale = alt.Scale(domain=x_domain, type='log', zero=False) if keys['x_log'] else alt.Scale(domain=x_domain, zero=False)
+    y_scale = alt.Scale(domain=y_domain, type='log', zero=False) if keys['y_log'] else alt.Scale(domain=y_domain, zero=False)
+    size_scale = alt.Scale(domain=size_domain, range=(30, 3000), zero=False)
+
+    return x_scale, y_scale, size_scale
+
+# Plot the bubble chart for all the years at once.
+# The year is a Vega-Lite parameter bound to a slider inside the chart,
+# so moving through the years is done in the browser without rerunning the app.
+# Like the bubble chart template, the spec has no data: the rows are sent next to it
+# as an Arrow table, and the spec is not built again by Altair on every rerun.
+# The keys have no 'year' here: the year shown first does not change the rows or the scales,
+# so the cache is not filled with one copy of the same chart per year
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES)
+def animatedChart(_wdi, version, keys, first, last):
+    df = _wdi.df
+    if len(keys['countries']) > 0:
+        df = _wdi.df_by_country.loc[keys['countries']]
 
-    selected = alt.selection_multi(encodings=['x', 'y', 'size'])
+    df = df[df['Year'].between(first, last)].dropna(subset=[keys['x'], keys['y']])
+    x_scale, y_scale, size_scale = bubbleScales(df, keys)
+    plot_df = chartColumns(df, 'Country', 'Region', 'Year', keys['x'], keys['y'], 'Population, total')
 
-    chart = alt.Chart(source).mark_circle(opacity=0.7, stroke='black', strokeWidth=1).encode(
+    year_param = alt.param(name='year', value=first,
+                           bind=alt.binding_range(min=first, max=last, step=1, name='Year '))
+
+    chart = alt.Chart().mark_circle(opacity=0.7, stroke='black', strokeWidth=1).encode(
         x=alt.X('{}:Q'.format(keys['x']), scale=x_scale),
         y=alt.Y('{}:Q'.format(keys['y']), scale=y_scale),
         size=alt.Size('Population, total:Q', scale=size_scale),
-        color=alt.condition(selected, alt.Color('Region:N'), alt.value('lightgray')),
-        tooltip='Country'
-    ).add_selection(selected).properties(width=800, height=500).interactive()
-
-    return chart
-
-new_chart = st.altair_chart(plotBubbleChart(df, keys), use_container_width=False)
-
-# What if we can animate the chart to see statistics over the years
-
-# Find the minimum and maximum year for the selected variables
-@st.cache()
-def minmaxYear(df, x, y):
-    temp_x = df[['Year', x]].dropna()
-    temp_y = df[['Year', y]].dropna()
-
-    first = max(temp_x['Year'].min(), temp_y['Year'].min())
-    last = min(temp_x['Year'].max(), temp_y['Year'].max())
-    return (first, last)
-
-# Add start and stop button and animate the chart over the years
-col1, col2 = st.columns(2)
-
-with col1:
-    start = st.button("Start")
-with col2:
-    stop = st.button("Stop")
-
-first, last = minmaxYear(df, keys['x'], keys['y'])
-if start:
-    for y in range(first, last+1):
-        text.markdown("Year: {}".format(y))
-        st.session_state['year'] = y
-        keys['year'] = y
-        new_chart.altair_chart(plotBubbleChart(df, keys, True))
-        time.sleep(0.2)
-
-if stop and 'year' in st.session_state:
-    keys['year'] = st.session_state.year
-    new_chart.altair_chart(plotBubbleChart(df, keys, True))
+        color=alt.Color('Region:N'),
+        tooltip='Country:N'
+    ).add_params(year_param).transform_filter(datum.Year == year_param).properties(width=800, height=500)
+
+    return plot_df.reset_index(drop=True), chart.to_dict()
+
+# Start the slider at the selected year (or the closest year with data),
+# in a shallow copy of the cached spec
+def animatedSpec(spec, year, first, last):
+    start_year = min(max(year, first), last)
+    params = [dict(param, value=start_year) if param['name'] == 'year' else param for param in spec['params']]
+    return dict(spec, params=params)
+
+# Add a checkbox to show the animated chart instead of the chart of the selected year
+# (unlike a button, it stays ticked when another widget reruns the app)
+# It is read before drawing, so that only the chart on display is built and sent
+animate = st.checkbox('Animate over the years')
+
+years = minmaxYear(keys['x'], keys['y'])
+if animate and years:
+    first, last = years
+    text.markdown("Years: {} - {}".format(first, last))
+    # Drawn once, the slider then updates the year in the browser
+    data_keys = {k: v for k, v in keys.items() if k != 'year'}
+    anim_source, anim_spec = animatedChart(wdi, wdi.version, data_keys, first, last)
+    st.vega_lite_chart(anim_source, animatedSpec(anim_spec, keys['year'], first, last), width='content')
+else:
+    st.vega_lite_chart(bubble_source, bubble_spec, width='content')
 
 # Relate the data between charts
 st.write('## 4. Interacting with other Altair charts')
@@ -188,6 +373,7 @@ st.write('## 4. Interacting with other Altair charts')
 # Plot the connected scatterplot
 def plotConnectedScatterplot(df, keys, countries):
     source = df[df['Country'].isin(countries)]
+    source = chartColumns(source, 'Country', 'Year', keys['x'], keys['y'])
 
     x_scale = alt.Scale(type='log', zero=False) if keys['x_log'] else alt.Scale(zero=False)
     y_scale = alt.Scale(type='log', zero=False) if keys['y_log'] else alt.Scale(zero=False)
@@ -204,21 +390,25 @@ def plotConnectedScatterplot(df, keys, countries):
 
 
 # Create another chart to related to the bubble chart
-selection = altair_component(altair_chart=plotBubbleChart(df, keys))
+# (the same data and spec as section 3, on_select="rerun" returns the selected points;
+# selection_mode leaves out the pan/zoom parameter of .interactive(), which would rerun the app too)
+event = st.vega_lite_chart(bubble_source, bubble_spec, on_select='rerun', selection_mode='selected',
+                           key='bubble_selection', width='content')
+points = event.selection.get('selected', [])
 
 # Add the selection to relate bubble chart with the connected scatter plot
-if selection.get("vlMulti"):
+if points:
     # What is the selection variable?
     st.success("Match found!")
-    #st.write(selection)
+    #st.write(event)
     
     # Convert selection to data frame
-    s = pd.DataFrame(selection['vlMulti']['or'])
+    s = pd.DataFrame(points)
     #st.dataframe(s)
     
-    # Find countries that match the selection
-    c = df.loc[(df['Year'] == keys['year']) & (df[keys['x']].isin(s[keys['x']])), 'Country']
+    # The selected points are the countries to show
+    c = s['Country']
     st.dataframe(c)
 
     # Plot the connected scatterplot chart
-    st.altair_chart(plotConnectedScatterplot(df, keys, c))
\ No newline at end of file
+    st.altair_chart(plotConnectedScatterplot(wdi.df, keys, c))
\ No newline at end of file